@@ -14,16 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import subprocess
+import time
+from contextlib import contextmanager
 
-import tenacity
-import yaml
-
-from charmhelpers.core import hookenv
-from charms import layer
+from charmhelpers.core import hookenv, unitdata
 from charms import reactive
-from charms.reactive.helpers import any_file_changed, data_changed
+from charms.reactive.helpers import data_changed
 from datetime import datetime, timedelta
 
 
@@ -43,6 +43,17 @@ def get_disabled_flag(snapname):
     return "snap.disabled.{}".format(snapname)
 
 
+def _core():
+    """Return charms.layer.snap_async, which implements much of this API.
+
+    Its coroutines are run with snap_async.run_sync(). It is imported on
+    first use, as it is itself built on this module.
+    """
+    from charms.layer import snap_async
+
+    return snap_async
+
+
 def install(snapname, **kw):
     """Install a snap.
 
@@ -54,27 +65,8 @@ def install(snapname, **kw):
     If the snap.installed.{snapname} flag is already set then the refresh()
     function is called.
     """
-    installed_flag = get_installed_flag(snapname)
-    local_flag = get_local_flag(snapname)
-    if reactive.is_flag_set(installed_flag):
-        refresh(snapname, **kw)
-    else:
-        if hookenv.has_juju_version("2.0"):
-            res_path = _resource_get(snapname)
-            if res_path is False:
-                _install_store(snapname, **kw)
-            else:
-                _install_local(res_path, **kw)
-                reactive.set_flag(local_flag)
-        else:
-            _install_store(snapname, **kw)
-        reactive.set_flag(installed_flag)
-
-    # Installing any snap will first ensure that 'core' is installed. Set an
-    # appropriate flag for consumers that want to get/set core options.
-    core_installed = get_installed_flag("core")
-    if not reactive.is_flag_set(core_installed):
-        reactive.set_flag(core_installed)
+    core = _core()
+    core.run_sync(core.install(snapname, **kw))
 
 
 def is_installed(snapname):
@@ -106,18 +98,8 @@ def refresh(snapname, **kw):
     # upload a zero byte resource, but then we would need to uninstall
     # the snap before reinstalling from the store and that has the
     # potential for data loss.
-    local_flag = get_local_flag(snapname)
-    if hookenv.has_juju_version("2.0"):
-        res_path = _resource_get(snapname)
-        if res_path is False:
-            _refresh_store(snapname, **kw)
-            reactive.clear_flag(local_flag)
-        else:
-            _install_local(res_path, **kw)
-            reactive.set_flag(local_flag)
-    else:
-        _refresh_store(snapname, **kw)
-        reactive.clear_flag(local_flag)
+    core = _core()
+    core.run_sync(core.refresh(snapname, **kw))
 
 
 def remove(snapname):
@@ -132,8 +114,8 @@ def connect(plug, slot):
     Each argument must be a two element tuple, corresponding to
     the two arguments to the 'snap connect' command.
     """
-    hookenv.log("Connecting {} to {}".format(plug, slot), hookenv.DEBUG)
-    subprocess.check_call(["snap", "connect", plug, slot])
+    core = _core()
+    core.run_sync(core.connect(plug, slot))
 
 
 def connect_all():
@@ -142,10 +124,8 @@ def connect_all():
     This method will fail if called before all referenced snaps have been
     installed.
     """
-    opts = layer.options("snap")
-    for snapname, snap_opts in opts.items():
-        for plug, slot in snap_opts.get("connect", []):
-            connect(plug, slot)
+    core = _core()
+    core.run_sync(core.connect_all())
 
 
 def disable(snapname):
@@ -210,15 +190,25 @@ def set(snapname, key, value):
 
     This method will fail if snapname is not an installed snap
     """
-    hookenv.log("Set config {}={} for snap {}".format(key, value, snapname))
-    if not reactive.is_flag_set(get_installed_flag(snapname)):
-        hookenv.log(
-            "Cannot set {} snap config because it is not installed".format(snapname),
-            hookenv.WARNING,
-        )
-        return
+    core = _core()
+    core.run_sync(core.set(snapname, key, value))
+
+
+def _unit_stagger(modulo):
+    """Return a stable offset in range(modulo) for this unit.
+
+    The offset is derived from a hash of the unit name, so it is the
+    same every time it is computed on a given unit but differs between
+    units of an application deployed at the same time.
+    """
+    digest = hashlib.sha256(hookenv.local_unit().encode("utf8")).hexdigest()
+    return int(digest, 16) % modulo
 
-    subprocess.check_call(["snap", "set", snapname, "{}={}".format(key, value)])
+
+def _stagger_window(offset, length=60):
+    """Return a refresh.timer time range starting offset minutes after midnight"""
+    end = offset + length
+    return "{:02d}:{:02d}-{:02d}:{:02d}".format(offset // 60 % 24, offset % 60, end // 60 % 24, end % 60)
 
 
 def set_refresh_timer(timer=""):
@@ -227,14 +217,20 @@ def set_refresh_timer(timer=""):
     This method sets how often snapd will refresh installed snaps. Call with
     an empty timer string to use the system default (currently 4x per day).
     Use 'max' to schedule refreshes as far into the future as possible
-    (currently 1 month). Also accepts custom timer strings as defined in the
-    refresh.timer section here:
+    (currently 1 month). Use 'stagger' to refresh 4x per day like the
+    default, but in one hour windows offset per unit. Also accepts custom
+    timer strings as defined in the refresh.timer section here:
       https://forum.snapcraft.io/t/system-options/87
 
+    Both 'max' and 'stagger' spread refreshes across the units of an
+    application using a hash of the unit name, so a fleet deployed at
+    the same time does not hit the Snap Store (or Snap Store Proxy) at
+    the same time.
+
     This method does not validate custom strings and will lead to a
     CalledProcessError if an invalid string is given.
 
-    :param: timer: empty string (default), 'max', or custom string
+    :param: timer: empty string (default), 'max', 'stagger' or custom string
     """
     if timer == "max":
         # A month from yesterday is the farthest we should delay to safely stay
@@ -244,11 +240,20 @@ def set_refresh_timer(timer=""):
         # 'thu2' (Thursday the 12th is the 2nd thursday of the month).
         # - Today is Tuesday the 1st, set the refresh timer to
         # 'mon5' (Monday the [28..31] is the 5th monday of the month).
-        yesterday = datetime.now() - timedelta(1)
-        dow = yesterday.strftime("%a").lower()
+        # Each unit steps back a further 0-6 days, so units deployed on
+        # the same day land on different weekdays, and picks its own
+        # hour long window within that day.
+        day = datetime.now() - timedelta(1 + _unit_stagger(7))
+        dow = day.strftime("%a").lower()
         # increment after int division because we want occurrence 1-5, not 0-4.
-        occurrence = yesterday.day // 7 + 1
-        timer = "{}{}".format(dow, occurrence)
+        occurrence = day.day // 7 + 1
+        window = _stagger_window(_unit_stagger(24 * 60))
+        timer = "{}{},{}".format(dow, occurrence, window)
+    elif timer == "stagger":
+        # Four one hour windows, 6 hours apart, starting somewhere in
+        # the first 6 hours of the day.
+        offset = _unit_stagger(6 * 60)
+        timer = ",".join(_stagger_window(offset + 6 * 60 * i) for i in range(4))
 
     # NB: 'system' became synonymous with 'core' in 2.32.5, but we use 'core'
     # here to ensure max compatibility.
@@ -256,51 +261,93 @@ def set_refresh_timer(timer=""):
     subprocess.check_call(["systemctl", "restart", "snapd.service"])
 
 
+def set_refresh_rate_limit(limit=""):
+    """Set the system refresh.rate-limit option (snapd 2.42+)
+
+    Limits the bandwidth snapd uses when downloading snaps during
+    automatic refreshes, such as '2MB' (bytes per second). Call with
+    an empty string to remove the limit.
+
+    :param: limit: empty string (default) or rate limit string
+    """
+    set(snapname="core", key="refresh.rate-limit", value=limit)
+
+
+def set_refresh_hold(hold=""):
+    """Set the system refresh.hold option (snapd 2.31+)
+
+    Postpones automatic refreshes until the given RFC 3339 timestamp,
+    such as '2020-01-31T00:00:00Z'. snapd caps this at 60 days from the
+    last refresh. Call with an empty string to remove the hold.
+
+    :param: hold: empty string (default) or RFC 3339 timestamp
+    """
+    set(snapname="core", key="refresh.hold", value=hold)
+
+
+def set_refresh_retain(retain=""):
+    """Set the system refresh.retain option (snapd 2.34+)
+
+    Sets how many revisions of each snap snapd keeps installed, including
+    the active revision. Call with an empty string to use the system
+    default (currently 3, or 2 on core systems).
+
+    :param: retain: empty string (default) or number of revisions
+    """
+    set(snapname="core", key="refresh.retain", value=retain)
+
+
+def prune_revisions(snapname, retain):
+    """Remove disabled revisions of a snap beyond the retain policy.
+
+    At most retain revisions are kept, including the active revision. The
+    highest disabled revision below the active one is always kept so that
+    the snap can still be reverted. Each retained revision costs disk space
+    and a mounted squashfs, so large snaps may want to keep fewer than the
+    system-wide refresh.retain setting.
+
+    Returns the list of revisions removed.
+    """
+    core = _core()
+    removed = core.run_sync(core.prune_revisions(snapname, int(retain)))
+    if removed:
+        hookenv.log("Pruned {} revisions {}".format(snapname, ", ".join(removed)))
+    return removed
+
+
+def get_disk_usage(snapname):
+    """Return the disk space used by all installed revisions of a snap.
+
+    Returns a mapping of revision to the size in bytes of its .snap file.
+    """
+    core = _core()
+    return core.run_sync(core.get_disk_usage(snapname))
+
+
 def get(snapname, key):
     """Gets configuration options for a snap
 
     This method returns the stripped output from the snap get command.
     This method will fail if snapname is not an installed snap.
     """
-    hookenv.log("Get config {} for snap {}".format(key, snapname))
-    if not reactive.is_flag_set(get_installed_flag(snapname)):
-        hookenv.log(
-            "Cannot get {} snap config because it is not installed".format(snapname),
-            hookenv.WARNING,
-        )
-        return
-
-    return subprocess.check_output(["snap", "get", snapname, key]).strip()
+    core = _core()
+    return core.run_sync(core.get(snapname, key, raw=True))
 
 
 def get_installed_version(snapname):
     """Gets the installed version of a snapname.
     This function will fail if snapname is not an installed snap.
     """
-    cmd = ["snap", "info", snapname]
-    hookenv.log("Get installed key for snap {}".format(snapname))
-    if not reactive.is_flag_set(get_installed_flag(snapname)):
-        hookenv.log(
-            "Cannot get {} snap installed version because it is not installed".format(snapname),
-            hookenv.WARNING,
-        )
-        return
-    return subprocess.check_output(cmd).decode("utf-8", errors="replace").partition("installed:")[-1].split()[0]
+    core = _core()
+    return core.run_sync(core.get_installed_version(snapname))
 
 
 def get_installed_channel(snapname):
     """Gets the tracking (channel) of a snapname.
     This function will fail if snapname is not an installed snap.
     """
-    cmd = ["snap", "info", snapname]
-    hookenv.log("Get channel for snap {}".format(snapname))
-    if not reactive.is_flag_set(get_installed_flag(snapname)):
-        hookenv.log(
-            "Cannot get snap tracking (channel) because it is not installed",
-            hookenv.WARNING,
-        )
-        return
-    return subprocess.check_output(cmd).decode("utf-8", errors="replace").partition("tracking:")[-1].split()[0]
+    core = _core()
+    return core.run_sync(core.get_installed_channel(snapname))
 
 
 def _snap_args(
@@ -326,63 +373,87 @@ def _snap_args(
         yield "--revision={}".format(revision)
 
 
-def _install_local(path, **kw):
-    key = "snap.local.{}".format(path)
-    if data_changed(key, kw) or any_file_changed([path]):
-        cmd = ["snap", "install"]
-        cmd.extend(_snap_args(**kw))
-        cmd.append("--dangerous")
-        cmd.append(path)
-        hookenv.log("Installing {} from local resource".format(path))
-        subprocess.check_call(cmd)
+def _file_md5(path):
+    """Return the md5 hex digest of path.
+
+    The file is read in fixed size chunks, so even multi-GB resources are
+    hashed without being buffered in memory or mapped into the address
+    space of 32-bit architectures.
+    """
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
 
-def _install_store(snapname, **kw):
-    """Install snap from store
+def _data_changed(key, data, update=True):
+    """data_changed(), optionally without recording the new data.
 
-    :param snapname: Name of snap to install
-    :type snapname: str
-    :param kw: Keyword arguments to pass on to ``snap install``
-    :type kw: Dict[str, str]
-    :raises: subprocess.CalledProcessError
+    Uses the same key and hash as charms.reactive's data_changed(), so
+    the two can be used interchangeably.
     """
-    cmd = ["snap", "install"]
-    cmd.extend(_snap_args(**kw))
-    cmd.append(snapname)
-    hookenv.log("Installing {} from store".format(snapname))
-
-    for attempt in tenacity.Retrying(
-        wait=tenacity.wait_fixed(10),  # seconds
-        stop=tenacity.stop_after_attempt(3),
-        reraise=True,
-    ):
-        with attempt:
-            try:
-                out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                hookenv.log(
-                    'Installation successful cmd="{}" output="{}"'.format(cmd, out),
-                    level=hookenv.DEBUG,
-                )
-                reactive.clear_flag(get_local_flag(snapname))
-            except subprocess.CalledProcessError as cp:
-                hookenv.log(
-                    'Installation failed cmd="{}" returncode={} output="{}"'.format(cmd, cp.returncode, cp.output),
-                    level=hookenv.ERROR,
-                )
-                raise
-
-
-def _refresh_store(snapname, **kw):
-    if not data_changed("snap.opts.{}".format(snapname), kw):
-        return
+    if update:
+        return data_changed(key, data)
+    data_hash = hashlib.md5(json.dumps(data, sort_keys=True).encode("utf8")).hexdigest()
+    return unitdata.kv().get("reactive.data_changed.{}".format(key)) != data_hash
+
+
+def _local_changed(path, kw, update=True):
+    """Return True if the resource at path or the install options changed.
 
-    # --amend allows us to refresh from a local resource
-    cmd = ["snap", "refresh", "--amend"]
-    cmd.extend(_snap_args(**kw))
-    cmd.append(snapname)
-    hookenv.log("Refreshing {} from store".format(snapname))
-    out = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    print(out)
+    Both are always checked, so that both are recorded on first install.
+    If update is False, the change is reported but not recorded.
+    """
+    opts_changed = _data_changed("snap.local.{}".format(path), kw, update)
+    return _file_changed(path, update) or opts_changed
+
+
+def _file_changed(path, update=True):
+    """Return True if the contents of the file at path changed.
+
+    The file is only hashed if its size, inode or modification time have
+    changed since it was last seen, so an unchanged resource is not
+    reread on every hook. The hash is stored under the same key as
+    charms.reactive's any_file_changed(), which this replaces.
+    """
+    st = os.stat(path)
+    fingerprint = [st.st_size, st.st_ino, st.st_mtime_ns]
+    kv = unitdata.kv()
+    stat_key = "snap.local.stat.{}".format(path)
+    hash_key = "reactive.files_changed.{}".format(path)
+    if kv.get(stat_key) == fingerprint and kv.get(hash_key) is not None:
+        return False
+    digest = _file_md5(path)
+    if update:
+        kv.set(stat_key, fingerprint)
+    if kv.get(hash_key) == digest:
+        return False
+    if update:
+        kv.set(hash_key, digest)
+    return True
+
+
+def plan_refresh(snapname, **kw):
+    """Describe what refresh(snapname, **kw) would do, without doing it.
+
+    Returns a dictionary with the following keys, where known:
+
+    * snap: the snap name
+    * action: 'install' if the snap is not yet installed, 'refresh' if a
+      new revision would be installed, 'switch' if only the channel or
+      options would change, or 'none'
+    * source: 'store', 'cache' if the target revision is already in the
+      shared snap cache, or 'resource' if installed from a Juju resource
+    * current-revision: the installed revision
+    * target-revision: the revision that would be installed
+    * download-size: bytes that would be downloaded from the store, which
+      is 0 if the target revision is already in the snap cache
+    * restarts: the services that a refresh or switch may restart, as
+      switching still amends the installed snap
+    """
+    core = _core()
+    return core.run_sync(core.plan_refresh(snapname, **kw))
 
 
 def _resource_get(snapname):
@@ -399,17 +470,8 @@ def _resource_get(snapname):
 
 def get_available_refreshes():
     """Return a list of snaps which have refreshes available."""
-    try:
-        out = subprocess.check_output(["snap", "refresh", "--list"]).decode("utf8")
-    except subprocess.CalledProcessError:
-        # If snap refresh fails for whatever reason, we should just return no
-        # refreshes available - LP:1869630.
-        return []
-
-    if out == "All snaps up to date.":
-        return []
-    else:
-        return [line.split()[0] for line in out.splitlines()[1:]]
+    core = _core()
+    return core.run_sync(core.get_available_refreshes())
 
 
 def is_refresh_available(snapname):
@@ -417,10 +479,6 @@ def is_refresh_available(snapname):
     return reactive.is_flag_set(get_refresh_available_flag(snapname))
 
 
-def _check_refresh_available(snapname):
-    return snapname in get_available_refreshes()
-
-
 def create_cohort_snapshot(snapname):
     """Create a new cohort key for the given snap.
 
@@ -433,9 +491,8 @@ def create_cohort_snapshot(snapname):
 
     Returns a cohort key.
     """
-    out = subprocess.check_output(["snap", "create-cohort", snapname])
-    data = yaml.safe_load(out.decode("utf8"))
-    return data["cohorts"][snapname]["cohort-key"]
+    core = _core()
+    return core.run_sync(core.create_cohort_snapshot(snapname))
 
 
 def join_cohort_snapshot(snapname, cohort_key):
@@ -445,11 +502,71 @@ def join_cohort_snapshot(snapname, cohort_key):
     to that of the new cohort snapshot. Note that this does not change the
     channel that the snap is in, only the revision within that channel.
     """
-    if is_local(snapname):
-        # joining a cohort can override a locally installed snap
-        hookenv.log("Skipping joining cohort for local snap: " "{}".format(snapname))
-        return
-    subprocess.check_output(["snap", "refresh", snapname, "--cohort", cohort_key])
-    # even though we just refreshed to the latest in the cohort, it's
-    # slightly possible that there's a newer rev available beyond the cohort
-    reactive.toggle_flag(get_refresh_available_flag(snapname), _check_refresh_available(snapname))
+    core = _core()
+    core.run_sync(core.join_cohort_snapshot(snapname, cohort_key))
+
+
+def _metrics_state_path():
+    return os.path.join(hookenv.charm_dir(), ".snap-metrics.json")
+
+
+def get_metrics_state():
+    """Return the recorded operation metrics for snaps managed by this layer.
+
+    Returns a dictionary keyed by snap name. Each entry may contain the
+    duration in seconds of the last successful install or refresh, the
+    number of failed installs and refreshes, and the cohort key last
+    joined.
+
+    This state is kept outside of the unit's key/value store so that
+    failures are still counted when the hook fails and is rolled back.
+    """
+    try:
+        with open(_metrics_state_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_metrics_state(snapname, **values):
+    path = _metrics_state_path()
+    state = get_metrics_state()
+    snap_state = state.setdefault(snapname, {})
+    for key, value in values.items():
+        if callable(value):
+            value = value(snap_state.get(key))
+        if value is None:
+            snap_state.pop(key, None)
+        else:
+            snap_state[key] = value
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def _measure(snapname):
+    """Record the duration or failure of an install or refresh of a snap.
+
+    The operation is an install if the snap is not yet flagged as
+    installed, and a refresh otherwise. Metrics are exported as soon as
+    an operation fails, as they are otherwise only exported when a hook
+    succeeds.
+    """
+    operation = "refresh" if is_installed(snapname) else "install"
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        _update_metrics_state(snapname, **{"{}_failures".format(operation): lambda n: (n or 0) + 1})
+        from charms.layer import snap_metrics
+
+        snap_metrics.export_configured()
+        raise
+    _update_metrics_state(snapname, **{"{}_seconds".format(operation): time.monotonic() - start})
+
+
+def _record_cohort(snapname, cohort_key):
+    """Record the cohort joined by the snap, or None if it is in no cohort"""
+    _update_metrics_state(snapname, cohort_key=cohort_key)
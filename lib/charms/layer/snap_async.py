@@ -0,0 +1,765 @@
+# Copyright 2016-2019 Canonical Ltd.
+#
+# This file is part of the Snap layer for Juju.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+asyncio counterparts to the charms.layer.snap API.
+
+These talk to the snapd REST API over its unix socket using non-blocking
+socket I/O, rather than blocking on the snap command line tool, so they
+can be gathered concurrently with each other and with other work:
+
+    await asyncio.gather(
+        snap_async.install("telegraf", channel="stable"),
+        snap_async.install("prometheus", channel="2/stable"),
+        fetch_relation_data(),
+    )
+
+Flags are managed exactly as by the synchronous API, which is implemented
+by running these same coroutines with run_sync().
+
+This module supports Python 3.5 (Ubuntu 16.04) and later, so it uses
+asyncio.get_event_loop() rather than get_running_loop(), which returns
+the running loop when called from a coroutine.
+"""
+
+import asyncio
+import json
+import socket
+import subprocess
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+import tenacity
+
+from charmhelpers.core import hookenv
+from charms import layer
+from charms import reactive
+from charms.layer import snap
+from charms.reactive.helpers import data_changed
+
+SNAPD_SOCKET = "/run/snapd.socket"
+
+# How often to poll snapd for the status of a change, in seconds.
+CHANGE_POLL_INTERVAL = 0.5
+
+
+class SnapdError(subprocess.CalledProcessError):
+    """An error response from the snapd API, or a failed snapd change.
+
+    This is a CalledProcessError, with the error message as its output, so
+    callers of the synchronous API that handle failures of the snap command
+    continue to work.
+    """
+
+    def __init__(self, message, kind=None, status=None):
+        super().__init__(1, "snapd", message.encode("utf8"))
+        self.message = message
+        self.kind = kind
+        self.status = status
+
+    def __str__(self):
+        return self.message
+
+
+class _IO(threading.local):
+    # Set while run_sync() drives a coroutine, so the I/O helpers below
+    # block rather than suspend.
+    blocking = False
+
+
+_io = _IO()
+
+
+async def _connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if _io.blocking:
+            sock.connect(SNAPD_SOCKET)
+        else:
+            sock.setblocking(False)
+            await asyncio.get_event_loop().sock_connect(sock, SNAPD_SOCKET)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+async def _sendall(sock, data):
+    if _io.blocking:
+        sock.sendall(data)
+    else:
+        await asyncio.get_event_loop().sock_sendall(sock, data)
+
+
+async def _recv(sock, size):
+    if _io.blocking:
+        return sock.recv(size)
+    return await asyncio.get_event_loop().sock_recv(sock, size)
+
+
+async def _sleep(seconds):
+    if _io.blocking:
+        time.sleep(seconds)
+    else:
+        await asyncio.sleep(seconds)
+
+
+async def _check_output(cmd):
+    """subprocess.check_output(), without blocking the event loop"""
+    if _io.blocking:
+        return subprocess.check_output(cmd)
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE)
+    out, _ = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
+
+
+async def _check_call(cmd):
+    """subprocess.check_call(), without blocking the event loop"""
+    if _io.blocking:
+        subprocess.check_call(cmd)
+        return
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    if await proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+async def call_blocking(func, *args):
+    """Call a blocking function without blocking the event loop.
+
+    The function is run in the loop's default executor, or called directly
+    when run by run_sync().
+    """
+    if _io.blocking:
+        return func(*args)
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def _request_head(method, path, headers):
+    # HTTP/1.0 so snapd closes the connection after responding, and
+    # never uses a chunked transfer encoding.
+    lines = ["{} {} HTTP/1.0".format(method, path), "Host: localhost"]
+    lines.extend("{}: {}".format(key, value) for key, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("ascii")
+
+
+async def _read_response(sock):
+    chunks = []
+    while True:
+        chunk = await _recv(sock, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    head, _, body = b"".join(chunks).partition(b"\r\n\r\n")
+    status = int(head.split(None, 2)[1])
+    try:
+        response = json.loads(body.decode("utf8"))
+    except ValueError:
+        raise SnapdError("Invalid response from snapd: {!r}".format(body[:200]), status=status)
+    if response.get("type") == "error":
+        result = response.get("result") or {}
+        raise SnapdError(result.get("message", "snapd error"), kind=result.get("kind"), status=status)
+    return response
+
+
+async def _request(method, path, body=None, query=None):
+    """Make a request to the snapd API and return the decoded response"""
+    if query:
+        path = "{}?{}".format(path, urlencode(query))
+    payload = b""
+    headers = {}
+    if body is not None:
+        payload = json.dumps(body).encode("utf8")
+        headers["Content-Type"] = "application/json"
+    headers["Content-Length"] = len(payload)
+    sock = await _connect()
+    try:
+        await _sendall(sock, _request_head(method, path, headers) + payload)
+        return await _read_response(sock)
+    finally:
+        sock.close()
+
+
+async def _wait(change_id):
+    """Wait for a snapd change to complete, raising SnapdError if it failed"""
+    while True:
+        change = (await _request("GET", "/v2/changes/{}".format(change_id)))["result"]
+        if change["ready"]:
+            if change["status"] != "Done":
+                raise SnapdError(change.get("err") or "Change {} {}".format(change_id, change["status"]))
+            return change
+        await _sleep(CHANGE_POLL_INTERVAL)
+
+
+async def _call(method, path, body=None, query=None):
+    """Make a request to the snapd API, waiting for any resulting change.
+
+    Returns the result of the request.
+    """
+    response = await _request(method, path, body, query)
+    if response.get("type") == "async":
+        await _wait(response["change"])
+    return response.get("result")
+
+
+def _snap_path(snapname, *parts):
+    return "/".join(["/v2/snaps", quote(snapname, safe="")] + list(parts))
+
+
+def _snap_instruction(
+    action,
+    channel="stable",
+    devmode=False,
+    jailmode=False,
+    dangerous=False,
+    force_dangerous=False,
+    connect=None,
+    classic=False,
+    revision=None,
+):
+    """The API equivalent of charms.layer.snap._snap_args"""
+    instruction = {"action": action, "channel": channel}
+    if devmode is True:
+        instruction["devmode"] = True
+    if jailmode is True:
+        instruction["jailmode"] = True
+    if force_dangerous is True or dangerous is True:
+        instruction["dangerous"] = True
+    if classic is True:
+        instruction["classic"] = True
+    if revision is not None:
+        instruction["revision"] = str(revision)
+    return instruction
+
+
+async def install(snapname, **kw):
+    """Install a snap.
+
+    The asyncio equivalent of charms.layer.snap.install().
+    """
+    installed_flag = snap.get_installed_flag(snapname)
+    local_flag = snap.get_local_flag(snapname)
+    if reactive.is_flag_set(installed_flag):
+        await refresh(snapname, **kw)
+    else:
+        if hookenv.has_juju_version("2.0"):
+            res_path = await _resource_get(snapname)
+            if res_path is False:
+                await _install_store(snapname, **kw)
+            else:
+                await _install_local(snapname, res_path, **kw)
+                reactive.set_flag(local_flag)
+        else:
+            await _install_store(snapname, **kw)
+        reactive.set_flag(installed_flag)
+
+    # Installing any snap will first ensure that 'core' is installed. Set an
+    # appropriate flag for consumers that want to get/set core options.
+    core_installed = snap.get_installed_flag("core")
+    if not reactive.is_flag_set(core_installed):
+        reactive.set_flag(core_installed)
+
+
+async def refresh(snapname, **kw):
+    """Update a snap.
+
+    The asyncio equivalent of charms.layer.snap.refresh().
+    """
+    local_flag = snap.get_local_flag(snapname)
+    if hookenv.has_juju_version("2.0"):
+        res_path = await _resource_get(snapname)
+        if res_path is False:
+            await _refresh_store(snapname, **kw)
+            reactive.clear_flag(local_flag)
+        else:
+            await _install_local(snapname, res_path, **kw)
+            reactive.set_flag(local_flag)
+    else:
+        await _refresh_store(snapname, **kw)
+        reactive.clear_flag(local_flag)
+
+
+async def connect(plug, slot):
+    """Connect or reconnect a snap plug with a slot.
+
+    Arguments are in the same 'snap:name' form as the arguments to the
+    'snap connect' command. An empty snap name refers to the system snap.
+    """
+    hookenv.log("Connecting {} to {}".format(plug, slot), hookenv.DEBUG)
+    plug_snap, _, plug_name = plug.partition(":")
+    slot_snap, _, slot_name = slot.partition(":")
+    body = {
+        "action": "connect",
+        "plugs": [{"snap": plug_snap, "plug": plug_name}],
+        "slots": [{"snap": slot_snap, "slot": slot_name}],
+    }
+    await _call("POST", "/v2/interfaces", body)
+
+
+async def connect_all():
+    """Connect or reconnect all interface connections defined in layer.yaml.
+
+    Connections are made one at a time, as snapd refuses concurrent
+    changes to the same snap.
+    """
+    opts = layer.options("snap")
+    for snapname, snap_opts in opts.items():
+        for plug, slot in snap_opts.get("connect", []):
+            await connect(plug, slot)
+
+
+async def set(snapname, key, value):
+    """Changes configuration options in a snap
+
+    As with 'snap set', string values that are valid JSON are decoded
+    before being stored.
+
+    This method will fail if snapname is not an installed snap
+    """
+    hookenv.log("Set config {}={} for snap {}".format(key, value, snapname))
+    if not reactive.is_flag_set(snap.get_installed_flag(snapname)):
+        hookenv.log(
+            "Cannot set {} snap config because it is not installed".format(snapname),
+            hookenv.WARNING,
+        )
+        return
+
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    await _call("PUT", _snap_path(snapname, "conf"), {key: value})
+
+
+async def get(snapname, key, raw=False):
+    """Gets configuration options for a snap
+
+    Returns the decoded value, or if raw is True the stripped output of
+    the snap get command, as charms.layer.snap.get() does.
+    This method will fail if snapname is not an installed snap.
+    """
+    hookenv.log("Get config {} for snap {}".format(key, snapname))
+    if not reactive.is_flag_set(snap.get_installed_flag(snapname)):
+        hookenv.log(
+            "Cannot get {} snap config because it is not installed".format(snapname),
+            hookenv.WARNING,
+        )
+        return
+
+    if raw:
+        return (await _check_output(["snap", "get", snapname, key])).strip()
+    result = await _call("GET", _snap_path(snapname, "conf"), query={"keys": key})
+    return result[key]
+
+
+async def get_installed_version(snapname):
+    """Gets the installed version of a snapname.
+    This function will fail if snapname is not an installed snap.
+    """
+    hookenv.log("Get installed key for snap {}".format(snapname))
+    if not reactive.is_flag_set(snap.get_installed_flag(snapname)):
+        hookenv.log(
+            "Cannot get {} snap installed version because it is not installed".format(snapname),
+            hookenv.WARNING,
+        )
+        return
+    return (await _call("GET", _snap_path(snapname)))["version"]
+
+
+async def get_installed_channel(snapname):
+    """Gets the tracking (channel) of a snapname.
+    This function will fail if snapname is not an installed snap.
+    """
+    hookenv.log("Get channel for snap {}".format(snapname))
+    if not reactive.is_flag_set(snap.get_installed_flag(snapname)):
+        hookenv.log(
+            "Cannot get snap tracking (channel) because it is not installed",
+            hookenv.WARNING,
+        )
+        return
+    result = await _call("GET", _snap_path(snapname))
+    # tracking-channel was added in snapd 2.44, channel is its predecessor.
+    return result.get("tracking-channel") or result.get("channel")
+
+
+async def list_installed(all_revisions=False):
+    """Return snapd's information on all installed snaps.
+
+    Only active revisions are included, unless all_revisions is True. Each
+    item is the mapping snapd returns for the snap, including its name,
+    version, revision, status, size and tracking channel.
+    """
+    if all_revisions:
+        return await _call("GET", "/v2/snaps", query={"select": "all"})
+    return await _call("GET", "/v2/snaps")
+
+
+def _revision_key(revision):
+    """Sort key ordering snap revisions numerically.
+
+    Local revisions (x1, x2, ...) are ordered by their number, after
+    store revisions.
+    """
+    revision = str(revision)
+    if revision.startswith("x"):
+        return (1, int(revision[1:]))
+    return (0, int(revision))
+
+
+async def list_revisions(snapname):
+    """Return snapd's information on every installed revision of a snap.
+
+    This includes disabled revisions retained for rollback, which have a
+    status of 'installed' rather than 'active'. Revisions are ordered
+    numerically, as snapd only reports when the active revision was
+    installed.
+    """
+    try:
+        result = await _call("GET", "/v2/snaps", query={"snaps": snapname, "select": "all"})
+    except SnapdError as e:
+        if e.kind == "snap-not-found":
+            return []
+        raise
+    return sorted(result, key=lambda r: _revision_key(r["revision"]))
+
+
+async def remove_revision(snapname, revision):
+    """Remove a single disabled revision of a snap"""
+    hookenv.log("Removing {} revision {}".format(snapname, revision))
+    await _call("POST", _snap_path(snapname), {"action": "remove", "revision": str(revision)})
+
+
+async def prune_revisions(snapname, retain):
+    """Remove disabled revisions of a snap beyond the retain policy.
+
+    At most retain revisions are kept, including the active revision,
+    preferring the highest numbered. The highest disabled revision below
+    the active revision is always kept, as it is the revision
+    'snap revert' returns to.
+
+    Returns the list of revisions removed.
+    """
+    revisions = await list_revisions(snapname)
+    active = [r["revision"] for r in revisions if r.get("status") == "active"]
+    disabled = [r["revision"] for r in revisions if r.get("status") != "active"]
+    keep_count = max(retain - 1, 0)
+    keep = disabled[max(len(disabled) - keep_count, 0) :]
+    below_active = [r for r in disabled if not active or _revision_key(r) < _revision_key(active[0])]
+    if below_active:
+        keep.append(below_active[-1])
+    removed = [r for r in disabled if r not in keep]
+    for revision in removed:
+        await remove_revision(snapname, revision)
+    return removed
+
+
+async def get_disk_usage(snapname):
+    """Return the disk space used by all installed revisions of a snap.
+
+    :returns: a mapping of revision to the size in bytes of its .snap
+    """
+    return {r["revision"]: r.get("installed-size", 0) for r in await list_revisions(snapname)}
+
+
+async def get_store_info(snapname):
+    """Return the Snap Store's information on the given snap.
+
+    This includes the snap's ID, base, and the revision and download
+    size of each channel.
+
+    :raises: SnapdError if the snap is not found in the store
+    """
+    result = await _call("GET", "/v2/find", query={"name": snapname})
+    return result[0]
+
+
+def normalize_channel(channel):
+    """Return the channel with an explicit track, as the store reports it.
+
+    For example 'stable' becomes 'latest/stable'.
+    """
+    if channel.split("/")[0] in ("stable", "candidate", "beta", "edge"):
+        return "latest/{}".format(channel)
+    return channel
+
+
+async def get_services(snapname):
+    """Return the systemd services of the installed snap"""
+    result = await _call("GET", _snap_path(snapname))
+    return ["snap.{}.{}".format(snapname, app["name"]) for app in result.get("apps", []) if app.get("daemon")]
+
+
+async def plan_refresh(snapname, **kw):
+    """Describe what refresh(snapname, **kw) would do, without doing it.
+
+    The asyncio equivalent of charms.layer.snap.plan_refresh().
+    """
+    plan = {"snap": snapname, "action": "none", "source": "store"}
+    installed = snap.is_installed(snapname)
+    if installed:
+        plan["current-revision"] = await get_installed_revision(snapname)
+    else:
+        plan["action"] = "install"
+
+    res_path = False
+    if hookenv.has_juju_version("2.0"):
+        res_path = await _resource_get(snapname)
+    if res_path is not False:
+        _plan_resource(plan, res_path, installed, kw)
+    elif not installed or snap._data_changed("snap.opts.{}".format(snapname), kw, update=False):
+        await _plan_store(plan, installed, kw)
+
+    # Switching still runs 'snap refresh --amend', which can restart
+    # services if options such as devmode change.
+    if installed and plan["action"] in ("refresh", "switch"):
+        plan["restarts"] = await get_services(snapname)
+    return plan
+
+
+def _plan_resource(plan, res_path, installed, kw):
+    plan["source"] = "resource"
+    plan["download-size"] = 0
+    if not installed or snap._local_changed(res_path, kw, update=False):
+        plan["action"] = "refresh" if installed else "install"
+
+
+async def _get_channel_info(snapname, channel):
+    """Return the snap ID, and the store's revision and download size for the channel"""
+    try:
+        info = await get_store_info(snapname)
+        return info["id"], info["channels"][normalize_channel(channel)]
+    except (SnapdError, KeyError, IndexError) as e:
+        hookenv.log("Unable to find {} in channel {}: {}".format(snapname, channel, e), hookenv.WARNING)
+        return None, {}
+
+
+async def _plan_store(plan, installed, kw):
+    # Imported here, as snap_cache is itself built on this module.
+    from charms.layer import snap_cache
+
+    snap_id, channel_info = await _get_channel_info(plan["snap"], kw.get("channel", "stable"))
+    target = kw.get("revision") or channel_info.get("revision")
+    if target is not None:
+        plan["target-revision"] = str(target)
+    if target is not None and plan.get("current-revision") == str(target):
+        plan["action"] = "switch"
+        plan["download-size"] = 0
+    else:
+        plan["action"] = "refresh" if installed else "install"
+        if target is not None and snap_cache.is_cached(snap_id, target):
+            plan["source"] = "cache"
+            plan["download-size"] = 0
+        elif str(target) == str(channel_info.get("revision")) and "size" in channel_info:
+            plan["download-size"] = channel_info["size"]
+
+
+async def get_available_refreshes():
+    """Return a list of snaps which have refreshes available."""
+    try:
+        result = await _call("GET", "/v2/find", query={"select": "refresh"})
+    except SnapdError as e:
+        # Nothing to refresh may be reported either as an empty result or
+        # as a snap-not-found error, so both mean no refreshes. Any other
+        # failure should also just return no refreshes available, as
+        # 'snap refresh --list' failing did - LP:1869630.
+        if e.kind != "snap-not-found":
+            hookenv.log("Unable to check for refreshes: {}".format(e), hookenv.WARNING)
+        return []
+    return [s["name"] for s in result or []]
+
+
+async def create_cohort_snapshot(snapname):
+    """Create a new cohort key for the given snap.
+
+    The asyncio equivalent of charms.layer.snap.create_cohort_snapshot().
+    """
+    result = await _call("POST", "/v2/cohorts", {"action": "create", "snaps": [snapname]})
+    return result[snapname]
+
+
+async def join_cohort_snapshot(snapname, cohort_key):
+    """Refresh the snap into the given cohort.
+
+    The asyncio equivalent of charms.layer.snap.join_cohort_snapshot().
+    """
+    if snap.is_local(snapname):
+        # joining a cohort can override a locally installed snap
+        hookenv.log("Skipping joining cohort for local snap: " "{}".format(snapname))
+        return
+    with snap._measure(snapname):
+        await _call("POST", _snap_path(snapname), {"action": "refresh", "cohort-key": cohort_key})
+    snap._record_cohort(snapname, cohort_key)
+    # even though we just refreshed to the latest in the cohort, it's
+    # slightly possible that there's a newer rev available beyond the cohort
+    reactive.toggle_flag(snap.get_refresh_available_flag(snapname), snapname in await get_available_refreshes())
+
+
+async def _resource_get(snapname):
+    # resource-get may need to download the resource from the controller.
+    return await call_blocking(snap._resource_get, snapname)
+
+
+async def _install_local(snapname, path, **kw):
+    # snapd only accepts a sideloaded snap as an upload, which it copies
+    # into its own blob directory, and resource-get downloads the resource
+    # again if the Juju copy is removed. Both copies are unavoidable, so
+    # the saving is in only rehashing the resource when it has changed.
+    if snap._local_changed(path, kw):
+        hookenv.log("Installing {} from local resource".format(path))
+        with snap._measure(snapname):
+            await install_file(path, **kw)
+
+
+async def _install_store(snapname, **kw):
+    """Install snap from store
+
+    :param snapname: Name of snap to install
+    :type snapname: str
+    :param kw: Keyword arguments to pass on to the snapd install action
+    :type kw: Dict[str, str]
+    :raises: SnapdError
+    """
+    body = _snap_instruction("install", **kw)
+    hookenv.log("Installing {} from store".format(snapname))
+
+    with snap._measure(snapname):
+        if await _install_cached(snapname, **kw):
+            reactive.clear_flag(snap.get_local_flag(snapname))
+            return
+        async for attempt in tenacity.AsyncRetrying(
+            sleep=_sleep,
+            wait=tenacity.wait_fixed(10),  # seconds
+            stop=tenacity.stop_after_attempt(3),
+            reraise=True,
+        ):
+            with attempt:
+                try:
+                    await _call("POST", _snap_path(snapname), body)
+                    hookenv.log(
+                        'Installation successful snap="{}" request="{}"'.format(snapname, body),
+                        level=hookenv.DEBUG,
+                    )
+                    reactive.clear_flag(snap.get_local_flag(snapname))
+                except SnapdError as e:
+                    hookenv.log(
+                        'Installation failed snap="{}" request="{}" error="{}"'.format(snapname, body, e),
+                        level=hookenv.ERROR,
+                    )
+                    raise
+
+
+async def _install_cached(snapname, **kw):
+    # Imported here, as snap_cache is itself built on this module.
+    from charms.layer import snap_cache
+
+    return await snap_cache.install(snapname, **kw)
+
+
+async def _refresh_store(snapname, **kw):
+    if not data_changed("snap.opts.{}".format(snapname), kw):
+        return
+
+    body = _snap_instruction("refresh", **kw)
+    # amend allows us to refresh from a local resource
+    body["amend"] = True
+    hookenv.log("Refreshing {} from store".format(snapname))
+    with snap._measure(snapname):
+        if await _install_cached(snapname, **kw):
+            return
+        await _call("POST", _snap_path(snapname), body)
+
+
+async def switch(snapname, channel):
+    """Switch the channel a snap is tracking, without refreshing it."""
+    await _call("POST", _snap_path(snapname), {"action": "switch", "channel": channel})
+
+
+async def install_file(path, signed=False, **kw):
+    """Install a snap from a local file with 'snap install'.
+
+    Keyword arguments are the same as for install().
+
+    :param signed: if True, the snap's assertions have already been
+                   acknowledged so it is installed as the store snap
+                   rather than as a dangerous local snap
+    """
+    cmd = ["snap", "install"]
+    cmd.extend(snap._snap_args(**kw))
+    if not signed:
+        cmd.append("--dangerous")
+    cmd.append(path)
+    await _check_call(cmd)
+
+
+async def get_installed_info(snapname):
+    """Return snapd's information on an installed snap, or None if not installed."""
+    try:
+        return await _call("GET", _snap_path(snapname))
+    except SnapdError as e:
+        if e.kind == "snap-not-found" or e.status == 404:
+            return None
+        raise
+
+
+async def get_installed_revision(snapname):
+    """Return the installed revision of a snap, or None if not installed."""
+    info = await get_installed_info(snapname)
+    return info and info["revision"]
+
+
+def run(coro):
+    """Run a coroutine from this module to completion from synchronous code.
+
+    Convenience for hooks that are otherwise synchronous, for example:
+
+        async def install_all():
+            await asyncio.gather(*(snap_async.install(s) for s in snaps))
+
+        snap_async.run(install_all())
+
+    This starts a new event loop, so cannot be used from within one. It is
+    the equivalent of asyncio.run(), which requires Python 3.7.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def run_sync(coro):
+    """Run a coroutine from this module to completion, blocking until done.
+
+    No event loop is used. While the coroutine runs, the I/O in this module
+    blocks rather than suspending, so the coroutine completes in a single
+    step. This is how the synchronous charms.layer.snap API is implemented,
+    and it can be used from synchronous code even within a running loop.
+    It cannot run gather() or other concurrent work; use run() for that.
+    """
+    blocking = _io.blocking
+    _io.blocking = True
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    finally:
+        _io.blocking = blocking
+    coro.close()
+    raise RuntimeError("{!r} suspended while run synchronously".format(coro))
@@ -0,0 +1,263 @@
+# Copyright 2016-2019 Canonical Ltd.
+#
+# This file is part of the Snap layer for Juju.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A snap cache shared by the units on a host.
+
+When the snap_cache_dir option points at a directory shared between units,
+such as a directory on the host bind mounted into each LXD container, store
+snaps are downloaded into it once and installed from there by every unit.
+
+Entries are keyed by snap ID and revision, and consist of the .snap and
+its .assert file. The assertions are acknowledged before the snap is
+installed, so it is installed as the store snap rather than as a
+dangerous local one. The least recently used entries are evicted when the
+cache grows beyond snap_cache_max_size megabytes.
+
+Snaps in a cohort are not installed through the cache, as the cache
+installs the head of the channel rather than the cohort's revision.
+"""
+
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+from charmhelpers.core import hookenv
+from charms.layer import snap_async
+
+# Download and install directories older than this, in seconds, were left
+# behind by a killed hook.
+STALE_AGE = 24 * 60 * 60
+
+
+def get_cache_dir():
+    """Return the configured cache directory, or None if caching is disabled"""
+    return hookenv.config().get("snap_cache_dir") or None
+
+
+def get_max_size():
+    """Return the configured cache size limit in bytes"""
+    return int(hookenv.config().get("snap_cache_max_size") or 0) * 1024 * 1024
+
+
+def _key(snap_id, revision):
+    return "{}_{}".format(snap_id, revision)
+
+
+def is_cached(snap_id, revision):
+    """Return True if the snap revision is in the configured cache"""
+    cache_dir = get_cache_dir()
+    if cache_dir is None or snap_id is None:
+        return False
+    return os.path.exists(os.path.join(cache_dir, _key(snap_id, revision) + ".snap"))
+
+
+@contextmanager
+def _locked(cache_dir, name=".lock"):
+    with open(os.path.join(cache_dir, name), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _entries(cache_dir):
+    """Return (mtime, size, key) for each cached snap, least recently used first"""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".snap"):
+            continue
+        key = name[: -len(".snap")]
+        size = 0
+        mtime = 0
+        for ext in (".snap", ".assert"):
+            try:
+                st = os.stat(os.path.join(cache_dir, key + ext))
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+        entries.append((mtime, size, key))
+    return sorted(entries)
+
+
+def _remove_stale(cache_dir):
+    """Remove download and install directories left behind by killed hooks"""
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        if not name.startswith((".download-", ".install-")):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if now - os.stat(path).st_mtime < STALE_AGE:
+                continue
+        except FileNotFoundError:
+            continue
+        hookenv.log("Removing stale {} from snap cache".format(name), hookenv.DEBUG)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def evict(cache_dir, max_size, keep=None):
+    """Remove least recently used entries until the cache fits in max_size.
+
+    Must be called with the cache locked. The entry named by keep is never
+    removed. Stale temporary directories are removed first.
+    """
+    _remove_stale(cache_dir)
+    entries = _entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+        if total <= max_size:
+            break
+        if key == keep:
+            continue
+        hookenv.log("Evicting {} from snap cache".format(key), hookenv.DEBUG)
+        for ext in (".snap", ".assert"):
+            try:
+                os.remove(os.path.join(cache_dir, key + ext))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def _link_entry(cache_dir, key):
+    """Return the assertions and a private hard link to a cached .snap.
+
+    Must be called with the cache locked. The link keeps the snap available
+    even if another unit evicts it before we have finished installing it.
+    The caller must remove the directory containing the link.
+    """
+    snap_path = os.path.join(cache_dir, key + ".snap")
+    # Mark the entry as recently used.
+    os.utime(snap_path)
+    with open(os.path.join(cache_dir, key + ".assert"), "rb") as f:
+        assertions = f.read()
+    tmpdir = tempfile.mkdtemp(prefix=".install-", dir=cache_dir)
+    link = os.path.join(tmpdir, key + ".snap")
+    os.link(snap_path, link)
+    return assertions, link
+
+
+def _lookup(cache_dir, snapname, revision, key):
+    """Return _link_entry() for a cached revision, or None on a miss"""
+    with _locked(cache_dir):
+        if os.path.exists(os.path.join(cache_dir, key + ".snap")):
+            hookenv.log("Using {} revision {} from snap cache".format(snapname, revision))
+            return _link_entry(cache_dir, key)
+    return None
+
+
+def _download(cache_dir, snapname, revision, key):
+    """Download a snap revision and its assertions into the cache.
+
+    The download is made without the cache locked, and the cache is only
+    locked to add the entry. Returns _link_entry() for the new entry.
+    """
+    tmpdir = tempfile.mkdtemp(prefix=".download-", dir=cache_dir)
+    try:
+        hookenv.log("Downloading {} revision {} into snap cache".format(snapname, revision))
+        subprocess.check_output(
+            [
+                "snap",
+                "download",
+                "--revision={}".format(revision),
+                "--target-directory={}".format(tmpdir),
+                "--basename={}".format(key),
+                snapname,
+            ],
+            stderr=subprocess.STDOUT,
+        )
+        with _locked(cache_dir):
+            # The assertions go first, so a .snap in the cache always has them.
+            for ext in (".assert", ".snap"):
+                os.rename(os.path.join(tmpdir, key + ext), os.path.join(cache_dir, key + ext))
+            evict(cache_dir, get_max_size(), keep=key)
+            return _link_entry(cache_dir, key)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _checkout(cache_dir, snapname, revision, key):
+    """Return the assertions and a private hard link to the cached .snap.
+
+    The entry is downloaded on a miss. The whole cache is only locked
+    briefly, so units never wait for another unit's download unless they
+    need the same revision. Those units wait on a lock for that entry
+    alone, so each revision is downloaded once.
+    """
+    entry = _lookup(cache_dir, snapname, revision, key)
+    if entry is None:
+        with _locked(cache_dir, ".lock-{}".format(key)):
+            entry = _lookup(cache_dir, snapname, revision, key) or _download(cache_dir, snapname, revision, key)
+    return entry
+
+
+def _ack(assertions):
+    with tempfile.NamedTemporaryFile(suffix=".assert") as f:
+        f.write(assertions)
+        f.flush()
+        subprocess.check_output(["snap", "ack", f.name], stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+async def install(snapname, channel="stable", revision=None, **kw):
+    """Install or refresh a snap from the store via the shared cache.
+
+    Keyword arguments are the same as for charms.layer.snap.install().
+
+    Returns False if caching is disabled, the snap cannot be found in the
+    store, the snap is in a cohort, the target revision is already
+    installed, or installing through the cache failed. The caller should
+    then install or refresh from the store directly, which also applies
+    any change of channel or options to an installed revision.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return False
+    try:
+        installed = await snap_async.get_installed_info(snapname)
+        if installed and (installed.get("cohort-key") or installed.get("cohort")):
+            hookenv.log("Not using snap cache for {}: it is in a cohort".format(snapname), hookenv.DEBUG)
+            return False
+        info = await snap_async.get_store_info(snapname)
+        if revision is None:
+            revision = info["channels"][snap_async.normalize_channel(channel)]["revision"]
+        snap_id = info["id"]
+    except (snap_async.SnapdError, KeyError, IndexError) as e:
+        hookenv.log("Not using snap cache for {}: {}".format(snapname, e), hookenv.DEBUG)
+        return False
+    if installed and installed["revision"] == str(revision):
+        return False
+
+    try:
+        key = _key(snap_id, revision)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Locking and downloading block, so keep them off the event loop.
+        assertions, snap_path = await snap_async.call_blocking(_checkout, cache_dir, snapname, revision, key)
+        try:
+            await snap_async.call_blocking(_ack, assertions)
+            await snap_async.install_file(snap_path, signed=True, channel=channel, **kw)
+        finally:
+            shutil.rmtree(os.path.dirname(snap_path), ignore_errors=True)
+        # Installs from a file do not track a channel.
+        await snap_async.switch(snapname, channel)
+    except Exception as e:
+        hookenv.log("Unable to install {} from snap cache: {}".format(snapname, e), hookenv.WARNING)
+        return False
+    return True
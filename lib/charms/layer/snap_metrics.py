@@ -0,0 +1,207 @@
+# Copyright 2016-2019 Canonical Ltd.
+#
+# This file is part of the Snap layer for Juju.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Export the state of snaps managed by the snap layer as Prometheus metrics.
+
+Metrics are written in the text exposition format, for collection by the
+node_exporter textfile collector.
+"""
+
+import hashlib
+import os
+
+from charmhelpers.core import hookenv
+from charms.layer import snap
+from charms.layer import snap_async
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name, labels, value):
+    label_str = ",".join('{}="{}"'.format(key, _escape(val)) for key, val in sorted(labels.items()))
+    return "{}{{{}}} {}".format(name, label_str, value)
+
+
+def _metric(lines, name, kind, description, samples):
+    if not samples:
+        return
+    lines.append("# HELP {} {}".format(name, description))
+    lines.append("# TYPE {} {}".format(name, kind))
+    lines.extend(samples)
+
+
+def render(installed=None):
+    """Return the metrics for snaps installed by this layer as a string.
+
+    :param installed: snapd's information on installed snaps, as returned by
+                      snap_async.list_installed(all_revisions=True). Queried
+                      if not given.
+    """
+    if installed is None:
+        installed = snap_async.run_sync(snap_async.list_installed(all_revisions=True))
+    managed = sorted(snap.get_installed_snaps())
+    info = {s["name"]: s for s in installed if s["name"] in managed and s.get("status", "active") == "active"}
+    revisions = {}
+    for s in installed:
+        revisions.setdefault(s["name"], []).append(s)
+    state = snap.get_metrics_state()
+    for name in managed:
+        # Forget the cohort once snapd no longer reports the snap in one.
+        if name in info and state.get(name, {}).get("cohort_key") and not info[name].get("cohort-key"):
+            snap._record_cohort(name, None)
+            del state[name]["cohort_key"]
+
+    lines = []
+    _metric(
+        lines,
+        "snap_info",
+        "gauge",
+        "Installed revision, version and tracking channel of the snap.",
+        [
+            _sample(
+                "snap_info",
+                dict(
+                    snap=name,
+                    revision=info[name]["revision"],
+                    version=info[name].get("version", ""),
+                    channel=info[name].get("tracking-channel") or info[name].get("channel", ""),
+                ),
+                1,
+            )
+            for name in managed
+            if name in info
+        ],
+    )
+    _metric(
+        lines,
+        "snap_retained_revisions",
+        "gauge",
+        "Number of installed revisions of the snap, including the active revision.",
+        [_sample("snap_retained_revisions", dict(snap=name), len(revisions[name])) for name in managed if name in info],
+    )
+    _metric(
+        lines,
+        "snap_disk_usage_bytes",
+        "gauge",
+        "Size of the installed revisions of the snap.",
+        [
+            _sample("snap_disk_usage_bytes", dict(snap=name), sum(r.get("installed-size", 0) for r in revisions[name]))
+            for name in managed
+            if name in info
+        ],
+    )
+    _metric(
+        lines,
+        "snap_local",
+        "gauge",
+        "Whether the snap was installed from a Juju resource.",
+        [_sample("snap_local", dict(snap=name), int(snap.is_local(name))) for name in managed],
+    )
+    _metric(
+        lines,
+        "snap_refresh_available",
+        "gauge",
+        "Whether a newer revision of the snap was available at the last check.",
+        [_sample("snap_refresh_available", dict(snap=name), int(snap.is_refresh_available(name))) for name in managed],
+    )
+    _metric(
+        lines,
+        "snap_cohort_info",
+        "gauge",
+        "Cohort joined by the snap, identified by a hash of the cohort key.",
+        [
+            _sample(
+                "snap_cohort_info",
+                dict(snap=name, cohort=hashlib.sha256(state[name]["cohort_key"].encode("utf8")).hexdigest()[:12]),
+                1,
+            )
+            for name in managed
+            if state.get(name, {}).get("cohort_key")
+        ],
+    )
+    for operation in ("install", "refresh"):
+        seconds = "{}_seconds".format(operation)
+        failures = "{}_failures".format(operation)
+        _metric(
+            lines,
+            "snap_last_{}_duration_seconds".format(operation),
+            "gauge",
+            "Duration of the last successful {} of the snap.".format(operation),
+            [
+                _sample("snap_last_{}_duration_seconds".format(operation), dict(snap=name), state[name][seconds])
+                for name in managed
+                if seconds in state.get(name, {})
+            ],
+        )
+        _metric(
+            lines,
+            "snap_{}_failures_total".format(operation),
+            "counter",
+            "Number of failed attempts to {} the snap.".format(operation),
+            [
+                _sample(
+                    "snap_{}_failures_total".format(operation),
+                    dict(snap=name),
+                    state.get(name, {}).get(failures, 0),
+                )
+                for name in managed
+            ],
+        )
+    return "\n".join(lines) + "\n"
+
+
+def export(path, installed=None):
+    """Write the metrics to path for the node_exporter textfile collector.
+
+    The file is only rewritten if the metrics have changed, and is replaced
+    atomically so the collector never sees a partially written file.
+
+    Returns True if the file was written.
+    """
+    content = render(installed)
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+
+    # The temporary file must be on the same filesystem for the rename to
+    # be atomic, and must not end in .prom or it may be collected.
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+    hookenv.log("Wrote snap metrics to {}".format(path), hookenv.DEBUG)
+    return True
+
+
+def export_configured():
+    """Write the metrics to the path set by the snap_metrics_path option.
+
+    Does nothing if the option is not set. Errors are logged rather than
+    raised, as metrics must never fail the hook.
+    """
+    path = hookenv.config().get("snap_metrics_path")
+    if not path:
+        return
+    try:
+        export(path)
+    except Exception as e:
+        hookenv.log("Unable to export snap metrics to {}: {}".format(path, e), hookenv.WARNING)
@@ -16,6 +16,7 @@
 """
 charms.reactive helpers for dealing with Snap packages.
 """
+import asyncio
 from collections import OrderedDict
 from distutils.version import LooseVersion
 import os.path
@@ -32,6 +33,7 @@ from charmhelpers.core.host import write_file
 from charms import layer
 from charms import reactive
 from charms.layer import snap
+from charms.layer import snap_async
 from charms.reactive import register_trigger, when, when_not, toggle_flag
 from charms.reactive.helpers import data_changed
 
@@ -50,6 +52,16 @@ class InvalidBundleError(Exception):
     pass
 
 
+class PrerequisiteFailedError(Exception):
+    def __init__(self, snapname, prerequisite):
+        super().__init__()
+        self.snapname = snapname
+        self.prerequisite = prerequisite
+
+    def __str__(self):
+        return "Not installing {0.snapname}, prerequisite {0.prerequisite} failed to install".format(self)
+
+
 def sorted_snap_opts():
     opts = layer.options("snap")
     opts = sorted(opts.items(), key=lambda item: item[0] != "core")
@@ -67,6 +79,7 @@ def install():
     # It probably should live in the base layer, blocking the charm
     # during bootstrap if the arch is unsupported.
     arch = uname().machine
+    pending = OrderedDict()
     for snapname, snap_opts in opts.items():
         supported_archs = snap_opts.pop("supported-architectures", None)
         if supported_archs and arch not in supported_archs:
@@ -78,13 +91,121 @@ def install():
                 ERROR,
             )
             continue
+        snap_opts.pop("retain", None)
         installed_flag = "snap.installed.{}".format(snapname)
         if not reactive.is_flag_set(installed_flag):
-            snap.install(snapname, **snap_opts)
+            pending[snapname] = snap_opts
+    if pending:
+        snap_async.run(install_pending(opts, pending))
     if data_changed("snap.install.opts", opts):
         snap.connect_all()
 
 
+async def _get_base(snapname):
+    try:
+        return (await snap_async.get_store_info(snapname)).get("base")
+    except Exception:
+        # Not in the store, perhaps provided as a resource, or the
+        # store is unreachable. Either way there is no known base.
+        return None
+
+
+def get_dependencies(opts, bases):
+    """Return the declared snaps each declared snap must be installed after.
+
+    Every snap depends on core, if declared. A snap also depends on its
+    base, and on the snaps providing the slots its plugs are connected
+    to by the connect entries in layer.yaml (such as content providers).
+
+    If the dependencies are circular, fall back to installing the snaps
+    one at a time in the order they are declared.
+
+    :param opts: the snap layer options, as returned by sorted_snap_opts()
+    :param bases: a mapping of snap name to the name of its base snap
+    :returns: a mapping of snap name to a set of snap names
+    """
+    deps = {snapname: set() for snapname in opts}
+    for snapname in opts:
+        if snapname != "core" and "core" in opts:
+            deps[snapname].add("core")
+        if bases.get(snapname) in opts:
+            deps[snapname].add(bases[snapname])
+    for snap_opts in opts.values():
+        for plug, slot in snap_opts.get("connect", []):
+            plug_snap = plug.partition(":")[0]
+            slot_snap = slot.partition(":")[0]
+            if plug_snap in deps and slot_snap in opts:
+                deps[plug_snap].add(slot_snap)
+    for snapname in deps:
+        deps[snapname].discard(snapname)
+
+    cycle = _find_cycle(deps)
+    if cycle:
+        hookenv.log(
+            "Circular snap dependencies between {}, installing sequentially".format(", ".join(sorted(cycle))),
+            hookenv.WARNING,
+        )
+        names = list(opts)
+        return {snapname: set(names[:i]) for i, snapname in enumerate(names)}
+    return deps
+
+
+def _find_cycle(deps):
+    """Return the snaps involved in circular dependencies, if any.
+
+    Snaps with no remaining dependencies are repeatedly removed; any
+    left over depend on each other.
+    """
+    remaining = {snapname: set(d) for snapname, d in deps.items()}
+    while remaining:
+        ready = [snapname for snapname, d in remaining.items() if not d]
+        if not ready:
+            return set(remaining)
+        for snapname in ready:
+            del remaining[snapname]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return set()
+
+
+async def install_pending(opts, pending):
+    """Install the pending snaps, in parallel where possible.
+
+    Each snap is installed as soon as the snaps it depends on have been
+    installed, rather than waiting for every snap declared before it.
+    If a snap fails to install, the snaps depending on it are skipped but
+    unrelated snaps are still installed. The first failure is raised once
+    all installs have completed.
+
+    :param opts: the snap layer options, as returned by sorted_snap_opts()
+    :param pending: the options for the snaps that need to be installed
+    """
+    names = list(pending)
+    bases = dict(zip(names, await asyncio.gather(*(_get_base(snapname) for snapname in names))))
+    deps = get_dependencies(opts, bases)
+    tasks = {}
+
+    async def install_one(snapname, snap_opts):
+        for prerequisite in sorted(deps[snapname]):
+            if prerequisite in tasks:
+                try:
+                    await tasks[prerequisite]
+                except Exception:
+                    raise PrerequisiteFailedError(snapname, prerequisite)
+        await snap_async.install(snapname, **snap_opts)
+
+    for snapname, snap_opts in pending.items():
+        tasks[snapname] = asyncio.ensure_future(install_one(snapname, snap_opts))
+    results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    failures = [(snapname, e) for snapname, e in zip(tasks, results) if isinstance(e, Exception)]
+    for snapname, e in failures:
+        hookenv.log("Failed to install snap {}: {}".format(snapname, e), ERROR)
+    for snapname, e in failures:
+        if not isinstance(e, PrerequisiteFailedError):
+            raise e
+
+
 def check_refresh_available():
     # Do nothing if we don't have kernel support yet
     if not kernel_supported():
@@ -110,10 +231,57 @@ def refresh():
         supported_archs = snap_opts.pop("supported-architectures", None)
         if supported_archs and arch not in supported_archs:
             continue
+        retain = get_retain(snap_opts.pop("retain", None))
         snap.refresh(snapname, **snap_opts)
+        if retain:
+            snap.prune_revisions(snapname, retain)
     snap.connect_all()
 
 
+def get_retain(snap_retain=None):
+    """Return the number of revisions of a snap to retain, or None.
+
+    The retain option of a snap in layer.yaml takes precedence over the
+    snapd_refresh_retain config option.
+    """
+    return snap_retain or get_config_retain()
+
+
+def get_config_retain():
+    """Return the snapd_refresh_retain config option, or None.
+
+    Values snapd would reject are logged and ignored, rather than failing
+    the hook.
+    """
+    retain = hookenv.config().get("snapd_refresh_retain")
+    if not retain:
+        return None
+    if not 2 <= retain <= 20:
+        hookenv.log(
+            "Ignoring snapd_refresh_retain={}, which must be from 2 to 20".format(retain),
+            hookenv.WARNING,
+        )
+        return None
+    return retain
+
+
+@reactive.hook("update-status")
+def prune_retained_revisions():
+    """Remove disabled revisions beyond each snap's retain policy.
+
+    snapd's automatic refreshes add revisions between charm upgrades, so
+    they are pruned regularly as well as after the layer refreshes.
+    """
+    # Do nothing if we don't have kernel support yet
+    if not kernel_supported():
+        return
+
+    for snapname, snap_opts in layer.options("snap").items():
+        retain = get_retain(snap_opts.get("retain"))
+        if retain and snap.is_installed(snapname):
+            snap.prune_revisions(snapname, retain)
+
+
 @reactive.hook("upgrade-charm")
 def upgrade_charm():
     refresh()
@@ -123,13 +291,6 @@ def get_series():
     return subprocess.check_output(["lsb_release", "-sc"], universal_newlines=True).strip()
 
 
-def snapd_supported():
-    # snaps are not supported in trusty lxc containers.
-    if get_series() == "trusty" and host.is_container():
-        return False
-    return True  # For all other cases, assume true.
-
-
 def kernel_supported():
     kernel_version = uname().release
 
@@ -144,18 +305,11 @@ def kernel_supported():
 
 
 def ensure_snapd():
-    if not snapd_supported():
-        hookenv.log("Snaps do not work in this environment", hookenv.ERROR)
-        raise Exception("Snaps do not work in this environment")
-
     # I don't use the apt layer, because that would tie this layer
     # too closely to apt packaging. Perhaps this is a snap-only system.
     if not shutil.which("snap"):
         os.environ["DEBIAN_FRONTEND"] = "noninteractive"
         cmd = ["apt-get", "install", "-y", "snapd"]
-        # LP:1699986: Force install of systemd on Trusty.
-        if get_series() == "trusty":
-            cmd.append("systemd")
         subprocess.check_call(cmd, universal_newlines=True)
 
     # Work around lp:1628289. Remove this stanza once snapd depends
@@ -339,6 +493,66 @@ def change_snapd_refresh():
     reactive.set_flag("snap.refresh.set")
 
 
+register_trigger(when="config.changed.snapd_refresh_rate_limit", clear_flag="snap.refresh-rate-limit.set")
+
+
+@when_not("snap.refresh-rate-limit.set")
+@when("snap.installed.core")
+def change_snapd_refresh_rate_limit():
+    """Set the system refresh.rate-limit option"""
+    limit = hookenv.config().get("snapd_refresh_rate_limit")
+    was_set = reactive.is_flag_set("snap.refresh-rate-limit.was-set")
+    if limit or was_set:
+        ensure_snapd_min_version("2.42")
+        snap.set_refresh_rate_limit(limit or "")
+    reactive.toggle_flag("snap.refresh-rate-limit.was-set", limit)
+    reactive.set_flag("snap.refresh-rate-limit.set")
+
+
+register_trigger(when="config.changed.snapd_refresh_hold", clear_flag="snap.refresh-hold.set")
+
+
+@when_not("snap.refresh-hold.set")
+@when("snap.installed.core")
+def change_snapd_refresh_hold():
+    """Set the system refresh.hold option"""
+    hold = hookenv.config().get("snapd_refresh_hold")
+    was_set = reactive.is_flag_set("snap.refresh-hold.was-set")
+    if hold or was_set:
+        ensure_snapd_min_version("2.31")
+        snap.set_refresh_hold(hold or "")
+    reactive.toggle_flag("snap.refresh-hold.was-set", hold)
+    reactive.set_flag("snap.refresh-hold.set")
+
+
+register_trigger(when="config.changed.snapd_refresh_retain", clear_flag="snap.refresh-retain.set")
+
+
+@when_not("snap.refresh-retain.set")
+@when("snap.installed.core")
+def change_snapd_refresh_retain():
+    """Set the system refresh.retain option, and prune retained revisions"""
+    retain = get_config_retain()
+    # An invalid value leaves refresh.retain as it was.
+    if retain or not hookenv.config().get("snapd_refresh_retain"):
+        was_set = reactive.is_flag_set("snap.refresh-retain.was-set")
+        if retain or was_set:
+            ensure_snapd_min_version("2.34")
+            snap.set_refresh_retain(retain or "")
+        reactive.toggle_flag("snap.refresh-retain.was-set", retain)
+    reactive.set_flag("snap.refresh-retain.set")
+    prune_retained_revisions()
+
+
+def export_metrics():
+    """Write the snap metrics file, if configured"""
+    if not kernel_supported():
+        return
+    from charms.layer import snap_metrics
+
+    snap_metrics.export_configured()
+
+
 # Bootstrap. We don't use standard reactive handlers to ensure that
 # everything is bootstrapped before any charm handlers are run.
 hookenv.atstart(hookenv.log, "Initializing Snap Layer")
@@ -347,3 +561,4 @@ hookenv.atstart(ensure_path)
 hookenv.atstart(update_snap_proxy)
 hookenv.atstart(configure_snap_store_proxy)
 hookenv.atstart(install)
+hookenv.atexit(export_metrics)
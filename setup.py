@@ -24,5 +24,6 @@ setup(
     packages=["charms/layer"],
     include_package_data=True,
     zip_safe=False,
+    python_requires=">=3.5",
     install_requires=["charmhelpers", "charms.reactive"],
 )